@@ -1,20 +1,33 @@
 from __future__ import annotations
 
+import io
 import os
 import re
-import base64
-import tempfile
+import ssl
+import time
+import asyncio
+import functools
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+import zipfile
+import xml.etree.ElementTree as ET
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import quote
+from typing import Optional, Dict, Any, AsyncIterator, Callable, Iterable, Iterator, List, Tuple, TypeVar, Union
 
 import httpx
+import orjson
+import pybase64
+from cachetools import TTLCache
+import numpy as np
 import pandas as pd
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from pydantic import BaseModel, field_validator
 from dotenv import load_dotenv
-from docx import Document
 import fitz  # PyMuPDF
 
 # =========================
@@ -40,8 +53,36 @@ ALLOWED_SITE_IDS = {s.strip() for s in os.getenv("ALLOWED_SITE_IDS", "").split("
 HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))  # seconds
 HTTP_MAX_REDIRECTS = int(os.getenv("HTTP_MAX_REDIRECTS", "5"))
 
+# In-memory TTL cache for Graph listing responses
+GRAPH_CACHE_TTL = float(os.getenv("GRAPH_CACHE_TTL", "60"))  # seconds
+GRAPH_CACHE_MAXSIZE = int(os.getenv("GRAPH_CACHE_MAXSIZE", "1024"))
+
+# Parsed Excel/PDF/DOCX results, keyed by item + eTag (only reused while the file is unchanged)
+PARSED_CACHE_TTL = float(os.getenv("PARSED_CACHE_TTL", "600"))  # seconds
+PARSED_CACHE_MAXSIZE = int(os.getenv("PARSED_CACHE_MAXSIZE", "32"))  # extracted-text entries
+PARSED_CACHE_BYTES = int(os.getenv("PARSED_CACHE_BYTES", str(256 << 20)))  # budget for Excel frames
+
+# File downloads: stream chunk size, and the size above which they spill to disk
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+DOWNLOAD_SPOOL_BYTES = int(os.getenv("DOWNLOAD_SPOOL_BYTES", str(16 << 20)))
+
+# Max worker threads parsing documents at once
+PARSE_MAX_THREADS = int(os.getenv("PARSE_MAX_THREADS", "8"))
+
+# Characters of extracted document text returned by /text (default, and ceiling for ?max_chars)
+TEXT_PREVIEW_CHARS = 3000
+TEXT_MAX_CHARS = int(os.getenv("TEXT_MAX_CHARS", "100000"))
+
+# Listing/search only return the DriveItem fields clients use, in one page
+DRIVE_ITEM_LIST_PARAMS = {"$select": "id,name,size,file,folder,webUrl", "$top": 200}
+
 AUTH_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
 GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+GRAPH_JSON_ACCEPT = "application/json;odata.metadata=none"
+DOWNLOAD_URL_KEY = "@microsoft.graph.downloadUrl"
+
+# One SSL context for the process; avoids re-parsing the CA bundle per client
+SSL_CONTEXT = ssl.create_default_context()
 
 # Logging
 logging.basicConfig(
@@ -49,15 +90,145 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
 )
 log = logging.getLogger(APP_NAME)
+# httpx logs every request URL at INFO; pre-authenticated download URLs carry
+# their credential in the query string, so keep that log off
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+T = TypeVar("T")
+
+
+# =========================
+# CORS (pure ASGI)
+# =========================
+
+_CORS_SAFELISTED_HEADERS = {"Accept", "Accept-Language", "Content-Language", "Content-Type"}
+_CORS_PREFLIGHT_VARY = b"Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Access-Control-Request-Private-Network"
+
+class FastCORS:
+    """Minimal pure-ASGI CORS layer with precomputed response headers.
+
+    Same policy as Starlette's CORSMiddleware with these settings (credentials
+    never allowed). Preflights are answered directly without touching the app;
+    other responses get allow-origin (allowed origins only, or "*" when
+    allow_origins contains it) and Vary on the way out.
+    """
+
+    def __init__(self, app: ASGIApp, allow_origins: List[str], allow_methods: List[str], allow_headers: List[str], max_age: int = 600) -> None:
+        self.app = app
+        # Same header policy as Starlette's CORSMiddleware: CORS-safelisted
+        # request headers are always allowed alongside the configured ones
+        allow_headers = sorted(_CORS_SAFELISTED_HEADERS | set(allow_headers))
+        # "*" allows every origin and is answered with a literal "*" (no credentials)
+        self._allow_all = "*" in allow_origins
+        self._origins = frozenset(allow_origins)
+        self._methods = frozenset(allow_methods)
+        self._headers = frozenset(h.lower() for h in allow_headers)
+        self._methods_str = ", ".join(allow_methods).encode()
+        self._headers_str = ", ".join(allow_headers).encode()
+        self._max_age = str(max_age).encode()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin: Optional[bytes] = None
+        req_method: Optional[bytes] = None
+        req_headers: Optional[bytes] = None
+        req_private_network = False
+        for key, value in scope["headers"]:
+            if key == b"origin":
+                origin = value
+            elif key == b"access-control-request-method":
+                req_method = value
+            elif key == b"access-control-request-headers":
+                req_headers = value
+            elif key == b"access-control-request-private-network":
+                req_private_network = True
+
+        allowed = origin is not None and (self._allow_all or origin.decode("latin-1") in self._origins)
+        allow_origin = b"*" if self._allow_all else origin
+
+        if origin is not None and req_method is not None and scope["method"] == "OPTIONS":
+            failures = []
+            if not allowed:
+                failures.append("origin")
+            if req_method.decode("latin-1") not in self._methods:
+                failures.append("method")
+            if req_headers is not None and any(
+                h.strip() not in self._headers for h in req_headers.decode("latin-1").lower().split(",")
+            ):
+                failures.append("headers")
+            if req_private_network:
+                failures.append("private-network")
+
+            body = ("Disallowed CORS " + ", ".join(failures)).encode() if failures else b"OK"
+            headers = [
+                (b"vary", _CORS_PREFLIGHT_VARY),
+                (b"access-control-allow-methods", self._methods_str),
+                (b"access-control-max-age", self._max_age),
+                (b"access-control-allow-headers", self._headers_str),
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ]
+            if allowed:
+                headers.append((b"access-control-allow-origin", allow_origin))
+            await send({"type": "http.response.start", "status": 400 if failures else 200, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_with_cors(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if allowed:
+                    headers.append((b"access-control-allow-origin", allow_origin))
+                # Always vary on Origin (even for no/disallowed origin) so a shared
+                # cache never serves one origin's response to another
+                headers.append((b"vary", b"Origin"))
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered by orjson (numpy scalars from pandas included; NaN -> null)."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+# =========================
+# Shared HTTP Client
+# =========================
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Single pooled client so Graph/auth calls reuse TCP+TLS connections.
+    # With brotli installed httpx advertises and decodes "br" on its own,
+    # which shrinks the large Graph listing payloads.
+    app.state.http = httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        max_redirects=HTTP_MAX_REDIRECTS,
+        http2=True,
+        verify=SSL_CONTEXT,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
 
 # FastAPI app
-app = FastAPI(title=APP_NAME)
+app = FastAPI(title=APP_NAME, default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Security-first CORS: default deny unless ALLOWED_ORIGINS provided
 app.add_middleware(
-    CORSMiddleware,
+    FastCORS,
     allow_origins=ALLOWED_ORIGINS if ALLOWED_ORIGINS else [],
-    allow_credentials=False,
     allow_methods=["GET", "OPTIONS"],
     allow_headers=["Authorization", "Content-Type"],
 )
@@ -70,13 +241,22 @@ app.add_middleware(
 class TokenCache:
     """Simple in-memory token cache for client-credentials flow."""
     _token: Optional[str] = None
-    _expires_at: Optional[datetime] = None
+    _expires_at: float = 0.0  # time.monotonic() deadline
+    _lock = asyncio.Lock()
 
     @classmethod
     async def get_token(cls) -> str:
-        if cls._token and cls._expires_at and datetime.utcnow() < cls._expires_at:
+        if cls._token and time.monotonic() < cls._expires_at:
             return cls._token
 
+        # Coalesce concurrent refreshes into a single auth call
+        async with cls._lock:
+            if cls._token and time.monotonic() < cls._expires_at:
+                return cls._token
+            return await cls._refresh()
+
+    @classmethod
+    async def _refresh(cls) -> str:
         if not (TENANT_ID and CLIENT_ID and CLIENT_SECRET):
             log.error("Missing OAuth environment variables")
             raise HTTPException(status_code=500, detail="Server authentication not configured")
@@ -88,23 +268,23 @@ class TokenCache:
             "grant_type": "client_credentials",
         }
 
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            resp = await client.post(AUTH_URL, data=data)
-            if resp.status_code != 200:
-                log.error("Auth failed: %s", resp.text[:400])
-                raise HTTPException(status_code=502, detail="Upstream auth error")
-
-            payload = resp.json()
-            cls._token = payload.get("access_token")
-            # Buffer expiry by 60 seconds
-            expires_in = int(payload.get("expires_in", 3600))
-            cls._expires_at = datetime.utcnow() + timedelta(seconds=max(0, expires_in - 60))
+        client: httpx.AsyncClient = app.state.http
+        resp = await client.post(AUTH_URL, data=data)
+        if resp.status_code != 200:
+            log.error("Auth failed: %s", resp.text[:400])
+            raise HTTPException(status_code=502, detail="Upstream auth error")
 
-            if not cls._token:
-                log.error("Auth response missing access_token")
-                raise HTTPException(status_code=502, detail="Upstream auth error")
+        payload = resp.json()
+        token = payload.get("access_token")
+        if not token:
+            log.error("Auth response missing access_token")
+            raise HTTPException(status_code=502, detail="Upstream auth error")
 
-            return cls._token
+        # Buffer expiry by 60 seconds
+        expires_in = int(payload.get("expires_in", 3600))
+        cls._token = token
+        cls._expires_at = time.monotonic() + max(0, expires_in - 60)
+        return token
 
 
 # =========================
@@ -117,50 +297,160 @@ def _sanitize_graph_error(text: str) -> str:
 
 async def graph_get(path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     token = await TokenCache.get_token()
-    headers = {"Authorization": f"Bearer {token}"}
+    # odata.metadata=none drops @odata.* annotations Graph would otherwise send
+    headers = {"Authorization": f"Bearer {token}", "Accept": GRAPH_JSON_ACCEPT}
+
+    url = path if path.startswith("http") else f"{GRAPH_BASE}{path}"
+    # Shared client follows redirects, which enables /content resolution
+    client: httpx.AsyncClient = app.state.http
+    resp = await client.get(url, headers=headers, params=params)
+    if resp.status_code >= 400:
+        log.warning("Graph GET %s -> %s", url, resp.status_code)
+        # Prefer not to echo full error to clients
+        raise HTTPException(status_code=502, detail=_sanitize_graph_error(resp.text))
+    # If JSON expected but content-type isn't JSON, caller should handle bytes
+    ctype = resp.headers.get("content-type", "")
+    body = resp.content
+    if "application/json" in ctype or "text/json" in ctype or body.startswith(b"{"):
+        try:
+            return orjson.loads(body)
+        except Exception:
+            # Some list endpoints always return JSON; if parse fails, treat as 502
+            raise HTTPException(status_code=502, detail="Invalid JSON from Microsoft Graph")
+    else:
+        # Return raw in a wrapper for content endpoints
+        return {"_raw_bytes": body, "_headers": dict(resp.headers)}
+
+# Short-lived cache for browse endpoints (sites/drives/root listing)
+_graph_cache: TTLCache = TTLCache(maxsize=GRAPH_CACHE_MAXSIZE, ttl=GRAPH_CACHE_TTL)
+
+async def graph_get_cached(path: str, params: Optional[Dict[str, Any]] = None, nocache: bool = False) -> Dict[str, Any]:
+    """graph_get with a TTL cache keyed on path+params; nocache refetches and refreshes the entry."""
+    key = (path, tuple(sorted((params or {}).items())))
+    if not nocache:
+        cached = _graph_cache.get(key)
+        if cached is not None:
+            return cached
+    data = await graph_get(path, params=params)
+    _graph_cache[key] = data
+    return data
+
+# Parsed document results; entries are keyed on the item's eTag so edits miss.
+# Extracted text is small and counted per entry; Excel frames can be hundreds
+# of MB, so they get their own cache bounded by total in-memory size.
+_text_cache: TTLCache = TTLCache(maxsize=PARSED_CACHE_MAXSIZE, ttl=PARSED_CACHE_TTL)
+_frame_cache: TTLCache = TTLCache(
+    maxsize=PARSED_CACHE_BYTES,
+    ttl=PARSED_CACHE_TTL,
+    # Entries are (df, nbytes); the size is measured in the parse thread since
+    # a deep memory_usage walks every string cell
+    getsizeof=lambda entry: entry[1],
+)
+
+async def graph_item_meta(item_path: str) -> Dict[str, Any]:
+    """
+    Fetch a DriveItem's eTag and pre-authenticated download URL in one call.
+
+    Downloading from the URL skips the /content -> 302 hop a later request
+    would otherwise make.
+    """
+    return await graph_get(item_path, params={"$select": f"eTag,{DOWNLOAD_URL_KEY}"})
 
+def item_content_url(item_path: str, meta: Dict[str, Any]) -> str:
+    """Where to fetch an item's bytes: its downloadUrl when present, else /content."""
+    return meta.get(DOWNLOAD_URL_KEY) or f"{item_path}/content"
+
+async def graph_open_stream(path: str) -> httpx.Response:
+    """Open a streaming GET; the caller must aclose() the response.
+
+    The bearer token is only sent to Graph itself; pre-authenticated download
+    URLs on other hosts carry their own short-lived credential.
+    """
     url = path if path.startswith("http") else f"{GRAPH_BASE}{path}"
-    # follow_redirects enables /content resolution
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, follow_redirects=True, limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)) as client:
-        resp = await client.get(url, headers=headers, params=params)
-        if resp.status_code >= 400:
-            log.warning("Graph GET %s -> %s", url, resp.status_code)
-            # Prefer not to echo full error to clients
-            raise HTTPException(status_code=502, detail=_sanitize_graph_error(resp.text))
-        # If JSON expected but content-type isn't JSON, caller should handle bytes
-        ctype = resp.headers.get("content-type", "")
-        if "application/json" in ctype or "text/json" in ctype or resp.text.startswith("{"):
+    headers = {}
+    if url.startswith(GRAPH_BASE):
+        token = await TokenCache.get_token()
+        headers["Authorization"] = f"Bearer {token}"
+    client: httpx.AsyncClient = app.state.http
+    resp = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    if resp.status_code >= 400:
+        await resp.aread()
+        await resp.aclose()
+        # Query strings on download URLs hold credentials; keep them out of logs
+        log.warning("Graph GET (stream) %s -> %s", url.split("?", 1)[0], resp.status_code)
+        raise HTTPException(status_code=502, detail=_sanitize_graph_error(resp.text))
+    return resp
+
+@asynccontextmanager
+async def graph_download(path: str, suffix: str) -> AsyncIterator[Union[io.BytesIO, str]]:
+    """
+    Stream a Graph download chunk by chunk and yield something parsers can open.
+
+    Files up to DOWNLOAD_SPOOL_BYTES stay in memory and come back as a BytesIO.
+    Larger files are spilled to a temp file and its path is yielded instead;
+    the file is removed on exit.
+    """
+    buf: Optional[io.BytesIO] = io.BytesIO()
+    tmp = None
+    try:
+        resp = await graph_open_stream(path)
+        try:
+            async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                if tmp is None and buf.tell() + len(chunk) > DOWNLOAD_SPOOL_BYTES:
+                    # Large file: spill to disk so memory stays bounded.
+                    # Disk I/O runs in threads so it doesn't stall the event loop.
+                    tmp = await asyncio.to_thread(tempfile.NamedTemporaryFile, suffix=suffix, delete=False)
+                    await asyncio.to_thread(tmp.write, buf.getbuffer())
+                    buf = None
+                if tmp is None:
+                    buf.write(chunk)
+                else:
+                    await asyncio.to_thread(tmp.write, chunk)
+        finally:
+            await resp.aclose()
+
+        if tmp is None:
+            buf.seek(0)
+            yield buf
+        else:
+            await asyncio.to_thread(tmp.close)
+            yield tmp.name
+    finally:
+        if tmp is not None:
+            await asyncio.to_thread(tmp.close)
             try:
-                return resp.json()
+                await asyncio.to_thread(os.remove, tmp.name)
             except Exception:
-                # Some list endpoints always return JSON; if parse fails, treat as 502
-                raise HTTPException(status_code=502, detail="Invalid JSON from Microsoft Graph")
-        else:
-            # Return raw in a wrapper for content endpoints
-            return {"_raw_bytes": resp.content, "_headers": dict(resp.headers)}
+                pass
 
-async def graph_get_bytes(path: str) -> bytes:
-    token = await TokenCache.get_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    url = path if path.startswith("http") else f"{GRAPH_BASE}{path}"
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, follow_redirects=True) as client:
-        resp = await client.get(url, headers=headers)
-        if resp.status_code >= 400:
-            log.warning("Graph GET (bytes) %s -> %s", url, resp.status_code)
-            raise HTTPException(status_code=502, detail=_sanitize_graph_error(resp.text))
-        return resp.content
+
+# =========================
+# Blocking Work
+# =========================
+
+# Bounds concurrent parser threads (pandas/PyMuPDF/DOCX XML) so a burst of
+# large files can't exhaust memory
+_parse_slots = asyncio.Semaphore(PARSE_MAX_THREADS)
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking parser in a worker thread so the event loop keeps serving requests."""
+    async with _parse_slots:
+        return await asyncio.to_thread(func, *args, **kwargs)
 
 
 # =========================
 # Models & Validators
 # =========================
 
-GUID_RE = re.compile(r"^[A-Za-z0-9\-_!.:]+$")  # lenient: Graph IDs are not strict GUIDs
+# Lenient: Graph IDs are not strict GUIDs. Deleting every allowed char via
+# str.translate leaves "" only for valid IDs, with no regex engine involved.
+_ID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_!.:"
+_ID_STRIP_TABLE = str.maketrans("", "", _ID_CHARS)
 
 def _validate_id(value: Optional[str], name: str) -> Optional[str]:
     if value is None:
         return None
-    if not GUID_RE.match(value):
+    if not value or value.translate(_ID_STRIP_TABLE):
         raise HTTPException(status_code=400, detail=f"Invalid {name}")
     return value
 
@@ -211,18 +501,21 @@ def ensure_defaults(site_id: Optional[str], drive_id: Optional[str]) -> (Optiona
 # Endpoints: Sites & Drives
 # =========================
 
+# Graph payloads are plain JSON already, so listing endpoints return
+# ORJSONResponse directly and skip FastAPI's jsonable_encoder walk.
+
 @app.get("/sharepoint/sites")
-async def list_sites():
+async def list_sites(nocache: bool = False):
     """List all accessible SharePoint sites."""
-    data = await graph_get("/sites?search=*")
-    return data.get("value", [])
+    data = await graph_get_cached("/sites?search=*", nocache=nocache)
+    return ORJSONResponse(data.get("value", []))
 
 @app.get("/sharepoint/site/{site_id}/drives")
-async def list_drives(site_id: str):
+async def list_drives(site_id: str, nocache: bool = False):
     site_id = _validate_id(site_id, "site_id")
     enforce_site_allowed(site_id)
-    data = await graph_get(f"/sites/{site_id}/drives")
-    return data.get("value", [])
+    data = await graph_get_cached(f"/sites/{site_id}/drives", nocache=nocache)
+    return ORJSONResponse(data.get("value", []))
 
 
 # =========================
@@ -230,13 +523,13 @@ async def list_drives(site_id: str):
 # =========================
 
 @app.get("/sharepoint/files")
-async def list_files(site_id: Optional[str] = None, drive_id: Optional[str] = None):
+async def list_files(site_id: Optional[str] = None, drive_id: Optional[str] = None, nocache: bool = False):
     site_id, drive_id = ensure_defaults(_validate_id(site_id, "site_id"), _validate_id(drive_id, "drive_id"))
     if not (site_id and drive_id):
         raise HTTPException(status_code=400, detail="site_id and drive_id are required (no defaults configured)")
     enforce_site_allowed(site_id)
-    data = await graph_get(f"/sites/{site_id}/drives/{drive_id}/root/children")
-    return data.get("value", [])
+    data = await graph_get_cached(f"/sites/{site_id}/drives/{drive_id}/root/children", params=DRIVE_ITEM_LIST_PARAMS, nocache=nocache)
+    return ORJSONResponse(data.get("value", []))
 
 @app.get("/sharepoint/search")
 async def search_files(query: str = Query(..., min_length=1), site_id: Optional[str] = None, drive_id: Optional[str] = None):
@@ -244,144 +537,358 @@ async def search_files(query: str = Query(..., min_length=1), site_id: Optional[
     if not (site_id and drive_id):
         raise HTTPException(status_code=400, detail="site_id and drive_id are required (no defaults configured)")
     enforce_site_allowed(site_id)
-    # Graph search within a drive
-    path = f"/sites/{site_id}/drives/{drive_id}/root/search(q='{query}')"
-    data = await graph_get(path)
-    return data.get("value", [])
+    # Graph search within a drive; OData escapes ' as '', then the literal is URL-encoded
+    q = quote(query.replace("'", "''"), safe="")
+    path = f"/sites/{site_id}/drives/{drive_id}/root/search(q='{q}')"
+    data = await graph_get(path, params=DRIVE_ITEM_LIST_PARAMS)
+    return ORJSONResponse(data.get("value", []))
 
 
 # =========================
 # Endpoints: Raw Content & Text Extraction
 # =========================
 
+async def _base64_json_stream(resp: httpx.Response, item_id: str) -> AsyncIterator[bytes]:
+    """
+    Yield the base64 content JSON object incrementally.
+
+    Input is re-cut on 3-byte boundaries so each piece encodes without
+    padding and the concatenation equals encoding the whole file at once.
+    size_bytes goes last since it is only known at the end.
+    """
+    yield b'{"file_id":' + orjson.dumps(item_id) + b',"file_type":"binary","base64_content":"'
+    size = 0
+    carry = b""
+    async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+        size += len(chunk)
+        data = carry + chunk if carry else chunk
+        cut = len(data) - len(data) % 3
+        carry = data[cut:]
+        if cut:
+            # SIMD encoder (pybase64)
+            yield pybase64.b64encode(memoryview(data)[:cut])
+    if carry:
+        yield pybase64.b64encode(carry)
+    yield b'","size_bytes":' + str(size).encode() + b"}"
+
 @app.get("/sharepoint/site/{site_id}/drive/{drive_id}/file/{item_id}/content")
-async def get_file_content(site_id: str, drive_id: str, item_id: str):
+async def get_file_content(site_id: str, drive_id: str, item_id: str, format: str = Query("base64", pattern="^(base64|raw)$")):
     site_id = _validate_id(site_id, "site_id")
     drive_id = _validate_id(drive_id, "drive_id")
     item_id = _validate_id(item_id, "item_id")
     enforce_site_allowed(site_id)
 
-    content = await graph_get_bytes(f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/content")
-    b64 = base64.b64encode(content).decode("utf-8")
-    return {
-        "file_id": item_id,
-        "file_type": "binary",
-        "base64_content": b64,
-        "size_bytes": len(content),
-    }
+    path = f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/content"
+
+    if format == "raw":
+        # Pass the bytes straight through: no buffering, no base64 inflation
+        resp = await graph_open_stream(path)
+        headers = {"X-File-Id": item_id}
+        if "content-length" in resp.headers and "content-encoding" not in resp.headers:
+            headers["Content-Length"] = resp.headers["content-length"]
+        return StreamingResponse(
+            resp.aiter_bytes(),
+            media_type="application/octet-stream",
+            headers=headers,
+            background=BackgroundTask(resp.aclose),
+        )
+
+    # Same JSON document as before, encoded chunk by chunk as the file arrives
+    resp = await graph_open_stream(path)
+    return StreamingResponse(
+        _base64_json_stream(resp, item_id),
+        media_type="application/json",
+        background=BackgroundTask(resp.aclose),
+    )
+
+def _join_until(pieces: Iterable[str], limit: int) -> Tuple[str, bool]:
+    """Newline-join pieces, stopping once the result is longer than limit.
+
+    Returns the text and whether it ran past limit (remaining pieces are skipped).
+    """
+    out: List[str] = []
+    size = -1  # no separator before the first piece
+    for piece in pieces:
+        out.append(piece)
+        size += len(piece) + 1
+        if size > limit:
+            return "\n".join(out), True
+    return "\n".join(out), False
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+_PKG_RELS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Run children and their text equivalents (same mapping python-docx uses)
+_RUN_TEXT = {
+    f"{_W}cr": "\n",
+    f"{_W}noBreakHyphen": "-",
+    f"{_W}ptab": "\t",
+    f"{_W}tab": "\t",
+}
+
+def _docx_run_text(run: ET.Element) -> str:
+    parts: List[str] = []
+    for e in run:
+        if e.tag == f"{_W}t":
+            parts.append(e.text or "")
+        elif e.tag == f"{_W}br":
+            # Line breaks only; page/column breaks carry no text
+            parts.append("\n" if e.get(f"{_W}type", "textWrapping") == "textWrapping" else "")
+        else:
+            parts.append(_RUN_TEXT.get(e.tag, ""))
+    return "".join(parts)
+
+def _docx_paragraph_texts(source: Union[io.BytesIO, str]) -> Iterator[str]:
+    """
+    Yield body-level paragraph text from a .docx, streaming the XML.
+
+    Matches python-docx's Document.paragraphs/Paragraph.text (runs and
+    hyperlink runs; tables and text boxes excluded) but parses lazily, so a
+    consumer that stops early never parses the rest of the document.
+    """
+    with zipfile.ZipFile(source) as zf:
+        part = "word/document.xml"
+        with zf.open("_rels/.rels") as rels:
+            for rel in ET.parse(rels).getroot().iter(f"{_PKG_RELS}Relationship"):
+                if rel.get("Type") == _OFFICE_DOCUMENT_REL:
+                    part = rel.get("Target", part).lstrip("/")
+                    break
+
+        with zf.open(part) as xml:
+            depth = 0
+            for event, el in ET.iterparse(xml, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                # document (0) > body (1) > block element (2)
+                if depth != 2:
+                    continue
+                if el.tag == f"{_W}p":
+                    runs: List[str] = []
+                    for child in el:
+                        if child.tag == f"{_W}r":
+                            runs.append(_docx_run_text(child))
+                        elif child.tag == f"{_W}hyperlink":
+                            runs.extend(_docx_run_text(r) for r in child if r.tag == f"{_W}r")
+                    yield "".join(runs)
+                # Drop finished blocks so memory stays flat on long documents
+                el.clear()
+
+def _extract_text(source: Union[io.BytesIO, str], filetype: str, limit: int) -> Tuple[str, bool]:
+    """Extract plain text from an in-memory or on-disk PDF/DOCX, stopping past limit chars."""
+    if filetype == "docx":
+        return _join_until(_docx_paragraph_texts(source), limit)
+    pdf_doc = fitz.open(source, filetype="pdf") if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
+    with pdf_doc as pdf:
+        return _join_until((page.get_text() for page in pdf), limit)
 
 @app.get("/sharepoint/site/{site_id}/drive/{drive_id}/file/{item_id}/text")
-async def extract_text(site_id: str, drive_id: str, item_id: str, filetype: str = Query("pdf", pattern="^(pdf|docx)$")):
+async def extract_text(
+    site_id: str,
+    drive_id: str,
+    item_id: str,
+    filetype: str = Query("pdf", pattern="^(pdf|docx)$"),
+    max_chars: int = Query(TEXT_PREVIEW_CHARS, ge=1, le=TEXT_MAX_CHARS),
+):
     site_id = _validate_id(site_id, "site_id")
     drive_id = _validate_id(drive_id, "drive_id")
     item_id = _validate_id(item_id, "item_id")
     enforce_site_allowed(site_id)
 
-    content = await graph_get_bytes(f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/content")
-
-    suffix = f".{filetype}"
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
-        tmp.write(content)
-        tmp_path = tmp.name
-
-    try:
-        if filetype == "docx":
-            text = "\n".join(p.text for p in Document(tmp_path).paragraphs)
-        else:
-            with fitz.open(tmp_path) as pdf:
-                text = "\n".join(page.get_text() for page in pdf)
-    except Exception as e:
-        log.warning("Text extraction failed: %s", str(e))
-        raise HTTPException(status_code=500, detail="Failed to parse document")
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    item_path = f"/sites/{site_id}/drives/{drive_id}/items/{item_id}"
+    meta = await graph_item_meta(item_path)
+    etag = meta.get("eTag")
+    cache_key = (item_path, etag, filetype, max_chars)
+    result = _text_cache.get(cache_key) if etag else None
 
+    if result is None:
+        async with graph_download(item_content_url(item_path, meta), f".{filetype}") as source:
+            try:
+                result = await run_blocking(_extract_text, source, filetype, max_chars)
+            except Exception as e:
+                log.warning("Text extraction failed: %s", str(e))
+                raise HTTPException(status_code=500, detail="Failed to parse document")
+        if etag:
+            _text_cache[cache_key] = result
+
+    text, truncated = result
     text = text or ""
-    return {"content": text[:3000], "length": len(text), "source_filetype": filetype}
+    # When truncated, "length" counts only the text read before stopping
+    return {
+        "content": text[:max_chars],
+        "length": len(text),
+        "truncated": truncated,
+        "source_filetype": filetype,
+    }
 
 
 # =========================
 # Endpoint: Excel (SAP-aware, filters, grouping)
 # =========================
 
-def _detect_columns(df: pd.DataFrame) -> Dict[str, str]:
-    """
-    Detects SAP-style columns dynamically (case-insensitive, substring and synonym matches).
-    Works for both supplier (AP) and customer (AR) exports.
-    """
-    cols = [str(c).strip().lower() for c in df.columns]
-    mapping: Dict[str, str] = {}
-
-    def find(*keys: str) -> Optional[str]:
-        """Return first matching column for any key fragment."""
-        for k in keys:
-            for c in cols:
-                # Match exact or substring (case-insensitive)
-                if k in c:
-                    return c
-        return None
-
+# Category -> candidate key fragments, in priority order (earlier keys win)
+_COLUMN_CATEGORIES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
     # === Business Partner Fields (AP + AR) ===
-    mapping["cardcode"] = find(
-        "cardcode", "vendor", "bpcode", "supplierid", "customer", "clientcode", "debitor", "partnercode"
-    )
-    mapping["cardname"] = find(
-        "cardname", "vendorname", "bpname", "suppliername", "customername", "clientname", "debitorname", "partnername"
-    )
+    ("cardcode", (
+        "cardcode", "vendor", "bpcode", "supplierid", "customer", "clientcode", "debitor", "partnercode",
+    )),
+    ("cardname", (
+        "cardname", "vendorname", "bpname", "suppliername", "customername", "clientname", "debitorname", "partnername",
+    )),
 
     # === Document Identifiers ===
-    mapping["docnum"] = find(
+    ("docnum", (
         "docnum", "docentry", "invoice", "invno", "invnum", "documentnumber", "po_no",
-        "po number", "doc no", "order", "salesorder", "purchaseorder"
-    )
+        "po number", "doc no", "order", "salesorder", "purchaseorder",
+    )),
 
     # === Dates ===
-    mapping["date"] = find(
-        "docdate", "taxdate", "postingdate", "posting", "duedate", "createdate", "date", "trandate"
-    )
+    ("date", (
+        "docdate", "taxdate", "postingdate", "posting", "duedate", "createdate", "date", "trandate",
+    )),
 
     # === Totals and Amounts (prefer detailed fields) ===
-    mapping["total"] = find(
+    ("total", (
         "linetotal", "doctotal", "totalamount", "amount", "grandtotal", "total", "netvalue",
-        "grossamount", "debit", "credit", "balance", "priceaftervat", "netamt"
-    )
+        "grossamount", "debit", "credit", "balance", "priceaftervat", "netamt",
+    )),
 
     # === Quantities ===
-    mapping["qty"] = find(
-        "quantity", "qty", "openqty", "baseqty", "shipqty", "delqty", "invoicedqty", "orderedqty"
-    )
+    ("qty", (
+        "quantity", "qty", "openqty", "baseqty", "shipqty", "delqty", "invoicedqty", "orderedqty",
+    )),
 
     # === Items / Materials ===
-    mapping["item"] = find(
-        "itemcode", "item", "dscription", "description", "material", "sku", "product", "partnumber", "materialcode"
-    )
+    ("item", (
+        "itemcode", "item", "dscription", "description", "material", "sku", "product", "partnumber", "materialcode",
+    )),
 
     # === Financial Details (optional enrichments) ===
-    mapping["tax"] = find("tax", "vat", "gst", "taxamt", "taxamount")
-    mapping["discount"] = find("disc", "discount", "discperc", "discamt", "discountamount")
-    mapping["currency"] = find("currency", "curr", "currcode")
-    mapping["warehouse"] = find("whscode", "warehouse", "location")
-    mapping["costcenter"] = find("costcenter", "profitcenter", "costctr", "pc", "division")
-    mapping["cardtype"] = find("cardtype", "bptype", "businesspartner", "bpgroup")
-
-    # === User-defined (custom) fields ===
+    ("tax", ("tax", "vat", "gst", "taxamt", "taxamount")),
+    ("discount", ("disc", "discount", "discperc", "discamt", "discountamount")),
+    ("currency", ("currency", "curr", "currcode")),
+    ("warehouse", ("whscode", "warehouse", "location")),
+    ("costcenter", ("costcenter", "profitcenter", "costctr", "pc", "division")),
+    ("cardtype", ("cardtype", "bptype", "businesspartner", "bpgroup")),
+)
+
+# Every key fragment across categories, as one alternation; a column matching
+# none of them can never be detected
+_ANY_COLUMN_KEY_RE = re.compile("|".join(
+    re.escape(k) for k in dict.fromkeys(k for _, keys in _COLUMN_CATEGORIES for k in keys)
+))
+
+def _is_detectable_column(name: Any) -> bool:
+    """usecols filter: keep only columns _detect_columns could map to a field."""
+    c = str(name).strip().lower()
+    return c.startswith("u_") or _ANY_COLUMN_KEY_RE.search(c) is not None
+
+def _detectable_columns_filter() -> Callable[[Any], bool]:
+    """
+    usecols filter for one read: detectable columns, plus the first header.
+
+    Keeping the first column means a sheet with no detectable headers still
+    loads its rows, so total_records stays the real row count.
+    """
+    seen_first = False
+
+    def keep(name: Any) -> bool:
+        nonlocal seen_first
+        if not seen_first:
+            seen_first = True
+            return True
+        return _is_detectable_column(name)
+
+    return keep
+
+def _detect_columns(columns: Iterable[Any]) -> Dict[str, str]:
+    """
+    Detects SAP-style columns dynamically (case-insensitive, substring and synonym matches).
+    Works for both supplier (AP) and customer (AR) exports.
+
+    Each column is visited once. A category keeps the column matched by its
+    highest-priority key fragment; ties go to the earlier column.
+    """
+    cols = [str(c).strip().lower() for c in columns]
+    best: Dict[str, Tuple[int, str]] = {}
+    userfields: Optional[str] = None
+
     for c in cols:
-        if c.startswith("u_") and "userfields" not in mapping:
-            mapping["userfields"] = c
-            break
+        for category, keys in _COLUMN_CATEGORIES:
+            # Only fragments that outrank the current match are worth testing
+            limit = best[category][0] if category in best else len(keys)
+            for rank in range(limit):
+                if keys[rank] in c:
+                    best[category] = (rank, c)
+                    break
+
+        # === User-defined (custom) fields ===
+        if userfields is None and c.startswith("u_"):
+            userfields = c
+
+    mapping = {category: best[category][1] for category, _ in _COLUMN_CATEGORIES if category in best}
+    if userfields:
+        mapping["userfields"] = userfields
+    return mapping
+
+
+@functools.lru_cache(maxsize=128)
+def _plan_columns(cols: Tuple[str, ...]) -> Tuple[Dict[str, str], Tuple[str, ...], Dict[str, str], Tuple[str, ...]]:
+    """
+    Column plan for a normalized header signature: (colmap, preview_cols, renames, group_keys).
 
-    # Filter out None values
-    return {k: v for k, v in mapping.items() if v}
+    SAP exports usually keep the same layout between runs, so repeat uploads
+    skip detection entirely. Cached values are shared; callers must not mutate them.
+    """
+    colmap = _detect_columns(cols)
+    preview_cols = tuple(colmap[k] for k in ("cardcode", "cardname", "docnum", "total", "date", "item") if k in colmap)
 
+    renames: Dict[str, str] = {}
+    group_keys: Tuple[str, ...] = ()
+    if "cardcode" in colmap and "total" in colmap:
+        group_keys = (colmap["cardcode"],) + ((colmap["cardname"],) if "cardname" in colmap else ())
+        renames = {
+            colmap["cardcode"]: "CardCode",
+            colmap.get("cardname", colmap["cardcode"]): "CardName",
+            colmap["total"]: "TotalAmount",
+        }
+    return colmap, preview_cols, renames, group_keys
 
 def _parse_datesafe(s: Optional[str]) -> Optional[datetime]:
     if not s:
         return None
     return datetime.strptime(s, "%Y-%m-%d")
 
+def _contains_ci(col: pd.Series, needle: str) -> pd.Series:
+    """Case-insensitive literal substring mask; missing cells never match."""
+    return col.astype("string").str.casefold().str.contains(needle.casefold(), regex=False, na=False)
+
+def _load_excel_frame(source: Union[io.BytesIO, str]) -> Tuple[pd.DataFrame, int]:
+    """
+    Read the first sheet with normalized headers and typed total/date columns (blocking).
+
+    Returns the frame and its in-memory size in bytes, for the frame cache.
+    """
+    # Rust-backed calamine engine (handles xlsx/xls/xlsb/ods); columns no field
+    # could map to are skipped so wide exports don't materialize them
+    df = pd.read_excel(source, engine="calamine", usecols=_detectable_columns_filter())
+    if df.empty:
+        return df, int(df.memory_usage(deep=True).sum())
+
+    df.columns = df.columns.map(str).str.strip().str.lower()
+    colmap = _plan_columns(tuple(df.columns))[0]
+
+    # calamine already yields typed columns for clean sheets; only coerce mixed ones
+    if "total" in colmap and not pd.api.types.is_numeric_dtype(df[colmap["total"]]):
+        df[colmap["total"]] = pd.to_numeric(df[colmap["total"]], errors="coerce")
+
+    if "date" in colmap and not pd.api.types.is_datetime64_any_dtype(df[colmap["date"]]):
+        df[colmap["date"]] = pd.to_datetime(df[colmap["date"]], errors="coerce")
+
+    return df, int(df.memory_usage(deep=True).sum())
+
 @app.get("/sharepoint/site/{site_id}/drive/{drive_id}/file/{item_id}/excel")
 async def analyze_excel(
     site_id: str,
@@ -414,23 +921,26 @@ async def analyze_excel(
     # -------------------------
     # Fetch Excel file from Graph
     # -------------------------
-    content = await graph_get_bytes(f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/content")
-
-    # Save to temp and load into pandas
-    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
-        tmp.write(content)
-        tmp_path = tmp.name
-
-    try:
-        df = pd.read_excel(tmp_path)
-    except Exception as e:
-        log.warning("Excel read failed: %s", str(e))
-        raise HTTPException(status_code=400, detail="Unsupported or corrupt Excel file")
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    item_path = f"/sites/{site_id}/drives/{drive_id}/items/{item_id}"
+    meta = await graph_item_meta(item_path)
+    etag = meta.get("eTag")
+    cache_key = (item_path, etag)
+    entry = _frame_cache.get(cache_key) if etag else None
+
+    if entry is None:
+        async with graph_download(item_content_url(item_path, meta), ".xlsx") as source:
+            try:
+                entry = await run_blocking(_load_excel_frame, source)
+            except Exception as e:
+                log.warning("Excel read failed: %s", str(e))
+                raise HTTPException(status_code=400, detail="Unsupported or corrupt Excel file")
+        if etag:
+            # Cached frames are shared between requests; below only slices them
+            try:
+                _frame_cache[cache_key] = entry
+            except ValueError:
+                pass  # larger than the whole budget: don't cache it
+    df = entry[0]
 
     if df.empty:
         return {
@@ -448,52 +958,45 @@ async def analyze_excel(
             "total_records": 0,
         }
 
-    # -------------------------
-    # Normalize headers
-    # -------------------------
-    df.columns = [str(c).strip().lower() for c in df.columns]
-    colmap = _detect_columns(df)
-
-    # -------------------------
-    # Normalize numeric & date fields
-    # -------------------------
-    if "total" in colmap:
-        df[colmap["total"]] = pd.to_numeric(df[colmap["total"]], errors="coerce")
-
-    if "date" in colmap:
-        df[colmap["date"]] = pd.to_datetime(df[colmap["date"]], errors="coerce")
+    colmap, preview_cols, renames, group_keys = _plan_columns(tuple(df.columns))
 
     # -------------------------
     # Apply filters
     # -------------------------
 
+    # All conditions are AND-ed into one mask so the frame is sliced once
+    mask = np.ones(len(df), dtype=bool)
+
     # Filter by CardCode (supplier/customer code)
     if cardcode and "cardcode" in colmap:
-        df = df[df[colmap["cardcode"]].astype(str).str.contains(cardcode, case=False, na=False)]
+        mask &= _contains_ci(df[colmap["cardcode"]], cardcode).to_numpy(dtype=bool)
 
     # Filter by numeric totals
     if min_total is not None and "total" in colmap:
-        df = df[df[colmap["total"]] >= float(min_total)]
+        mask &= (df[colmap["total"]] >= float(min_total)).to_numpy()
     if max_total is not None and "total" in colmap:
-        df = df[df[colmap["total"]] <= float(max_total)]
+        mask &= (df[colmap["total"]] <= float(max_total)).to_numpy()
 
     # Filter by date range
     sd = _parse_datesafe(start_date)
     ed = _parse_datesafe(end_date)
     if sd and "date" in colmap:
-        df = df[df[colmap["date"]] >= sd]
+        mask &= (df[colmap["date"]] >= sd).to_numpy()
     if ed and "date" in colmap:
-        df = df[df[colmap["date"]] <= ed]
+        mask &= (df[colmap["date"]] <= ed).to_numpy()
 
     # NEW: Keyword search (e.g., “WatchGuard” in item description or supplier name)
     if keyword:
-        kw = keyword.strip().lower()
+        kw = keyword.strip()
         text_cols = [colmap.get(k) for k in ["item", "dscription", "cardname"] if colmap.get(k)]
         if text_cols:
-            mask = pd.Series(False, index=df.index)
+            kw_mask = np.zeros(len(df), dtype=bool)
             for c in text_cols:
-                mask |= df[c].astype(str).str.lower().str.contains(kw, na=False)
-            df = df[mask]
+                kw_mask |= _contains_ci(df[c], kw).to_numpy(dtype=bool)
+            mask &= kw_mask
+
+    # Only the grouping/preview columns are used past this point
+    df = df.loc[mask, list(dict.fromkeys(preview_cols))]
 
     # -------------------------
     # Aggregate totals per business partner
@@ -501,29 +1004,18 @@ async def analyze_excel(
     total_records = int(len(df))
     supplier_totals: List[Dict[str, Any]] = []
 
-    if "cardcode" in colmap and "total" in colmap and total_records > 0:
-        group_keys = [colmap["cardcode"]]
-        if "cardname" in colmap:
-            group_keys.append(colmap["cardname"])
-
+    if group_keys and total_records > 0:
         grouped = (
-            df.groupby(group_keys, dropna=False)[colmap["total"]]
+            df.groupby(list(group_keys), dropna=False, observed=True)[colmap["total"]]
             .sum()
             .reset_index()
         )
-
-        renames = {
-            colmap["cardcode"]: "CardCode",
-            colmap.get("cardname", colmap["cardcode"]): "CardName",
-            colmap["total"]: "TotalAmount",
-        }
         supplier_totals = grouped.rename(columns=renames).to_dict(orient="records")
 
     # -------------------------
     # Prepare sample preview (PII-safe)
     # -------------------------
-    preview_cols = [colmap.get(k) for k in ["cardcode", "cardname", "docnum", "total", "date", "item"] if colmap.get(k)]
-    sample_records = df[preview_cols].head(10).to_dict(orient="records") if preview_cols else []
+    sample_records = df.head(10)[list(preview_cols)].to_dict(orient="records") if preview_cols else []
 
     # -------------------------
     # Return structured response